@@ -15,6 +15,8 @@ from CustomLoss import CustomLoss
 
 # Start ................
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# Note: batch shapes are static per period, so let cudnn autotune once and cache the plan
+torch.backends.cudnn.benchmark = True
 # os.environ['CUDA_LAUNCH_BLOCKING'] = '1'
 # torch.autograd.set_detect_anomaly(True) # Note : Tremendously slowing down program - Attention: Be careful!
 
@@ -30,11 +32,12 @@ for i in range(4):
     torch.manual_seed(2024 + i)
     np.random.seed(2024 + i)
     random.seed(2024 + i)
-    models.append(Metamorph(no_frame_samples, batch_size, input_window_size, device).to(device))
+    models.append(Metamorph(no_frame_samples, batch_size, input_window_size, device))
+# Note: parameters are initialized on the CPU, so move all models in one sweep
+# instead of paying the allocator/transfer churn inside the seeded loop
+models = [model.to(device, non_blocking=True) for model in models]
 
-no_layers = 0
-for (name, param) in models[0].named_parameters():
-    no_layers += 1
+no_layers = sum(1 for _ in models[0].parameters())
 discriminator = Metamorph_discriminator(no_frame_samples, batch_size, input_window_size, device).to(device)
 parameterReinforcer = Metamorph_parameterReinforcer(no_layers, 10, 100, 20, 128, input_window_size, device).to(device)
 
@@ -50,36 +53,47 @@ t = teacher(models, discriminator, parameterReinforcer, device)
 t.fsim = fl.flame_sim(no_frames=no_frames, frame_skip=frame_skip)
 
 OT_backend = 'tensorized'
-criterion_model = CustomLoss(device)
-criterion_e0 = CustomLoss(device)
-criterion_e1 = CustomLoss(device)
-criterion_e2 = CustomLoss(device)
+# Note: CustomLoss carries no per-model state (batch_size is reset before every
+# use), so the model and all experts can share one instance instead of four
+criterion_model = criterion_e0 = criterion_e1 = criterion_e2 = CustomLoss(device)
 criterion_disc = nn.BCELoss(reduction='mean')
 criterion_RL = nn.MSELoss(reduction='mean')
 criterion = criterion_model, criterion_e0, criterion_e1, criterion_e2, criterion_disc, criterion_RL
+# Note: the model/experts and the discriminator carry cfloat parameters, which
+# fused Adam rejects; foreach still batches their updates into multi-tensor
+# kernels. Only the all-real reinforcer can take the fully fused path.
 optimizer = torch.optim.Adam([
     {'params': t.model.parameters()},
     {'params': t.expert_0.parameters()},
     {'params': t.expert_1.parameters()},
     {'params': t.expert_2.parameters()}
-], lr=1e-2, betas=(0.9, 0.999), eps=1e-08, weight_decay=1e-6, amsgrad=False)
+], lr=1e-2, betas=(0.9, 0.999), eps=1e-08, weight_decay=1e-6, amsgrad=False, foreach=True)
 disc_optimizer = torch.optim.Adam(t.discriminator.parameters(), lr=5e-4, betas=(0.9, 0.999), eps=1e-08,
-                                  weight_decay=1e-6, amsgrad=False)
+                                  weight_decay=1e-6, amsgrad=False, foreach=True)
 RL_optimizer = torch.optim.Adam(t.parameterReinforcer.parameters(), lr=5e-3, betas=(0.9, 0.999), eps=1e-08,
-                                weight_decay=1e-6, amsgrad=False)
+                                weight_decay=1e-6, amsgrad=False, fused=torch.cuda.is_available())
 
 # torch.autograd.set_detect_anomaly(True)
 # Note: Eon > Era > Period > Epoch
 no_periods = 1
 t.no_of_periods = no_periods
 # model.load_state_dict(torch.load('model.pt'Ś))
+def run_flame_sim():
+    fsim = fl.flame_sim(no_frames=1000, frame_skip=frame_skip)
+    fsim.igni_time = no_frames
+    # t.generate_structure()
+    fsim.fuel_dens_modifier = 1 / fsim.dt
+    fsim.simulate(simulate=0, save_rgb=1, save_alpha=1, save_fuel=1, delete_data=0)
+    return fsim
+
+
 for period in range(1, no_periods + 1):
     t.period = period
-    t.fsim = fl.flame_sim(no_frames=1000, frame_skip=frame_skip)
-    t.fsim.igni_time = no_frames
-    # t.generate_structure()
-    t.fsim.fuel_dens_modifier = 1 / t.fsim.dt
-    t.fsim.simulate(simulate=0, save_rgb=1, save_alpha=1, save_fuel=1, delete_data=0)
+    # Note: the simulation must not overlap training - simulate() rewrites the
+    # same v/u/rgb/alpha/... folders that data_preparation re-reads every epoch,
+    # so prefetching the next period would race on disk. Keep it serial until
+    # the engine can write frames into per-period directories.
+    t.fsim = run_flame_sim()
     t.learning_phase(t, no_frame_samples, batch_size, input_window_size, first_frame,
                      last_frame, frame_skip * 2, criterion, optimizer, disc_optimizer, RL_optimizer, device, learning=1,
                      num_epochs=1000)
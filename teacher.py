@@ -30,6 +30,7 @@ class teacher(object):
         self.discriminator = discriminator
         self.parameterReinforcer = parameterReinforcer
         self.device = device
+        self.copy_stream = torch.cuda.Stream() if torch.cuda.is_available() else None
         self.fsim = None
         self.period = 1
         self.no_of_periods = 1
@@ -99,6 +100,25 @@ class teacher(object):
     def generate_sim_params(self):
         pass
 
+    def stage_to_device(self, tensor):
+        # Note : issue the H2D copy on the side stream so staging the next
+        # dataset overlaps with compute running on the default stream
+        if self.copy_stream is not None:
+            with torch.cuda.stream(self.copy_stream):
+                if tensor.device.type == 'cpu':
+                    tensor = tensor.pin_memory()
+                staged = tensor.to(self.device, non_blocking=True)
+            # Note : the tensor is consumed on the default stream; record that
+            # so the allocator does not hand its block back to the copy stream
+            # (for the next staging round) while queued kernels may still read it
+            staged.record_stream(torch.cuda.current_stream())
+            return staged
+        return tensor.to(self.device)
+
+    def wait_for_staging(self):
+        if self.copy_stream is not None:
+            torch.cuda.current_stream().wait_stream(self.copy_stream)
+
     def data_preparation(self, create_val_dataset=0):
         folder_names = ['v', 'u', 'velocity_magnitude', 'fuel_density', 'oxidizer_density',
                         'product_density', 'pressure', 'temperature', 'rgb', 'alpha']
@@ -413,44 +433,44 @@ class teacher(object):
                 noise_var_out.append(noise_variance_out_binary.to(torch.float))
 
         if create_val_dataset == 1:
-            self.data_input_val = torch.stack(data_input, dim=0)[0:self.batch_size].to(self.device)
-            self.structure_input_val = torch.stack(structure_input, dim=0)[0:self.batch_size].to(self.device)
-            self.meta_input_h1_val = torch.stack(meta_input_h1, dim=0)[0:self.batch_size].to(self.device)
-            self.meta_input_h2_val = torch.stack(meta_input_h2, dim=0)[0:self.batch_size].to(self.device)
-            self.meta_input_h3_val = torch.stack(meta_input_h3, dim=0)[0:self.batch_size].to(self.device)
-            self.meta_input_h4_val = torch.stack(meta_input_h4, dim=0)[0:self.batch_size].to(self.device)
-            self.meta_input_h5_val = torch.stack(meta_input_h5, dim=0)[0:self.batch_size].to(self.device)
-            self.noise_var_in_val = torch.stack(noise_var_in, dim=0)[0:self.batch_size].to(self.device)
-            self.fmot_in_val = torch.stack(fmot_in, dim=0)[0:self.batch_size].to(self.device)
-            self.fmot_in_binary_val = torch.stack(fmot_in_binary, dim=0)[0:self.batch_size].to(self.device)
-            self.data_output_val = torch.stack(data_output, dim=0)[0:self.batch_size].to(self.device)
-            self.structure_output_val = torch.stack(structure_output, dim=0)[0:self.batch_size].to(self.device)
-            self.meta_output_h1_val = torch.stack(meta_output_h1, dim=0)[0:self.batch_size].to(self.device)
-            self.meta_output_h2_val = torch.stack(meta_output_h2, dim=0)[0:self.batch_size].to(self.device)
-            self.meta_output_h3_val = torch.stack(meta_output_h3, dim=0)[0:self.batch_size].to(self.device)
-            self.meta_output_h4_val = torch.stack(meta_output_h4, dim=0)[0:self.batch_size].to(self.device)
-            self.meta_output_h5_val = torch.stack(meta_output_h5, dim=0)[0:self.batch_size].to(self.device)
-            self.noise_var_out_val = torch.stack(noise_var_out, dim=0)[0:self.batch_size].to(self.device)
+            self.data_input_val = self.stage_to_device(torch.stack(data_input, dim=0)[0:self.batch_size])
+            self.structure_input_val = self.stage_to_device(torch.stack(structure_input, dim=0)[0:self.batch_size])
+            self.meta_input_h1_val = self.stage_to_device(torch.stack(meta_input_h1, dim=0)[0:self.batch_size])
+            self.meta_input_h2_val = self.stage_to_device(torch.stack(meta_input_h2, dim=0)[0:self.batch_size])
+            self.meta_input_h3_val = self.stage_to_device(torch.stack(meta_input_h3, dim=0)[0:self.batch_size])
+            self.meta_input_h4_val = self.stage_to_device(torch.stack(meta_input_h4, dim=0)[0:self.batch_size])
+            self.meta_input_h5_val = self.stage_to_device(torch.stack(meta_input_h5, dim=0)[0:self.batch_size])
+            self.noise_var_in_val = self.stage_to_device(torch.stack(noise_var_in, dim=0)[0:self.batch_size])
+            self.fmot_in_val = self.stage_to_device(torch.stack(fmot_in, dim=0)[0:self.batch_size])
+            self.fmot_in_binary_val = self.stage_to_device(torch.stack(fmot_in_binary, dim=0)[0:self.batch_size])
+            self.data_output_val = self.stage_to_device(torch.stack(data_output, dim=0)[0:self.batch_size])
+            self.structure_output_val = self.stage_to_device(torch.stack(structure_output, dim=0)[0:self.batch_size])
+            self.meta_output_h1_val = self.stage_to_device(torch.stack(meta_output_h1, dim=0)[0:self.batch_size])
+            self.meta_output_h2_val = self.stage_to_device(torch.stack(meta_output_h2, dim=0)[0:self.batch_size])
+            self.meta_output_h3_val = self.stage_to_device(torch.stack(meta_output_h3, dim=0)[0:self.batch_size])
+            self.meta_output_h4_val = self.stage_to_device(torch.stack(meta_output_h4, dim=0)[0:self.batch_size])
+            self.meta_output_h5_val = self.stage_to_device(torch.stack(meta_output_h5, dim=0)[0:self.batch_size])
+            self.noise_var_out_val = self.stage_to_device(torch.stack(noise_var_out, dim=0)[0:self.batch_size])
         else:
-            self.data_input = torch.stack(data_input, dim=0).to(self.device)
-            self.structure_input = torch.stack(structure_input, dim=0).to(self.device)
-            self.meta_input_h1 = torch.stack(meta_input_h1, dim=0).to(self.device)
-            self.meta_input_h2 = torch.stack(meta_input_h2, dim=0).to(self.device)
-            self.meta_input_h3 = torch.stack(meta_input_h3, dim=0).to(self.device)
-            self.meta_input_h4 = torch.stack(meta_input_h4, dim=0).to(self.device)
-            self.meta_input_h5 = torch.stack(meta_input_h5, dim=0).to(self.device)
-            self.noise_diff_in = torch.stack(noise_var_in, dim=0).to(self.device)
-            self.fmot_in = torch.stack(fmot_in, dim=0).to(self.device)
-            self.fmot_in_binary = torch.stack(fmot_in_binary, dim=0).to(self.device)
-
-            self.data_output = torch.stack(data_output, dim=0).to(self.device)
-            self.structure_output = torch.stack(structure_output, dim=0).to(self.device)
-            self.meta_output_h1 = torch.stack(meta_output_h1, dim=0).to(self.device)
-            self.meta_output_h2 = torch.stack(meta_output_h2, dim=0).to(self.device)
-            self.meta_output_h3 = torch.stack(meta_output_h3, dim=0).to(self.device)
-            self.meta_output_h4 = torch.stack(meta_output_h4, dim=0).to(self.device)
-            self.meta_output_h5 = torch.stack(meta_output_h5, dim=0).to(self.device)
-            self.noise_diff_out = torch.stack(noise_var_out, dim=0).to(self.device)
+            self.data_input = self.stage_to_device(torch.stack(data_input, dim=0))
+            self.structure_input = self.stage_to_device(torch.stack(structure_input, dim=0))
+            self.meta_input_h1 = self.stage_to_device(torch.stack(meta_input_h1, dim=0))
+            self.meta_input_h2 = self.stage_to_device(torch.stack(meta_input_h2, dim=0))
+            self.meta_input_h3 = self.stage_to_device(torch.stack(meta_input_h3, dim=0))
+            self.meta_input_h4 = self.stage_to_device(torch.stack(meta_input_h4, dim=0))
+            self.meta_input_h5 = self.stage_to_device(torch.stack(meta_input_h5, dim=0))
+            self.noise_diff_in = self.stage_to_device(torch.stack(noise_var_in, dim=0))
+            self.fmot_in = self.stage_to_device(torch.stack(fmot_in, dim=0))
+            self.fmot_in_binary = self.stage_to_device(torch.stack(fmot_in_binary, dim=0))
+
+            self.data_output = self.stage_to_device(torch.stack(data_output, dim=0))
+            self.structure_output = self.stage_to_device(torch.stack(structure_output, dim=0))
+            self.meta_output_h1 = self.stage_to_device(torch.stack(meta_output_h1, dim=0))
+            self.meta_output_h2 = self.stage_to_device(torch.stack(meta_output_h2, dim=0))
+            self.meta_output_h3 = self.stage_to_device(torch.stack(meta_output_h3, dim=0))
+            self.meta_output_h4 = self.stage_to_device(torch.stack(meta_output_h4, dim=0))
+            self.meta_output_h5 = self.stage_to_device(torch.stack(meta_output_h5, dim=0))
+            self.noise_diff_out = self.stage_to_device(torch.stack(noise_var_out, dim=0))
 
     def examine(self, criterion, device, plot=0):
         self.model.load_state_dict(torch.load('model.pt'))
@@ -781,6 +801,7 @@ class teacher(object):
             # zero = torch.tensor([0.],requires_grad=True).to(device).float()
             self.data_preparation(1)
             self.data_preparation()
+            self.wait_for_staging()
             val_idx = torch.arange(self.data_input_val.shape[0])
             self.validation_dataset = (
                 self.data_input_val, self.structure_input_val, self.meta_input_h1_val, self.meta_input_h2_val,
@@ -795,6 +816,7 @@ class teacher(object):
                 self.seed_setter(int(epoch + 1))
                 if reiterate_data == 0:
                     self.data_preparation()
+                    self.wait_for_staging()
                     self.parameterReinforcer.create_masks(self.data_input_val, self.structure_input_val)
                     print("new sets of data and masks prepared!")
                 else:
@@ -905,17 +927,13 @@ class teacher(object):
                     e1idx = torch.argmin(e1loss)
                     e2idx = torch.argmin(e2loss)
                     optimizer.zero_grad(set_to_none=True)
-                    loss[lidx].backward()
-                    e0loss[e0idx].backward()
-                    e1loss[e1idx].backward()
-                    e2loss[e2idx].backward()
+                    # Note : the expert graphs are independent, so one stacked
+                    # backward produces the same grads as four separate passes
+                    torch.stack((loss[lidx], e0loss[e0idx], e1loss[e1idx], e2loss[e2idx])).sum().backward()
                     optimizer.step()
                 else:
                     optimizer.zero_grad(set_to_none=True)
-                    loss.backward()
-                    e0loss.backward()
-                    e1loss.backward()
-                    e2loss.backward()
+                    (loss + e0loss + e1loss + e2loss).backward()
                     max_norm = 1.
                     nn_utils.clip_grad_norm_(self.model.parameters(), max_norm)
                     nn_utils.clip_grad_norm_(self.expert_0.parameters(), max_norm)
@@ -976,7 +994,7 @@ class teacher(object):
                         self.discriminator.weight_reset()
                         self.discriminator.init_weights()
                         disc_optimizer = torch.optim.Adam(self.discriminator.parameters(), lr=5e-4, betas=(0.9, 0.999),
-                                                          eps=1e-08, weight_decay=1e-6, amsgrad=False)
+                                                          eps=1e-08, weight_decay=1e-6, amsgrad=False, foreach=True)
 
                         grad_counter = 0
                     # NOTE: Averaging models with best loss results within all models
@@ -1051,7 +1069,7 @@ class teacher(object):
                                 self.discriminator.init_weights()
                                 disc_optimizer = torch.optim.Adam(self.discriminator.parameters(), lr=5e-4,
                                                                   betas=(0.9, 0.999), eps=1e-08,
-                                                                  weight_decay=1e-6, amsgrad=False)
+                                                                  weight_decay=1e-6, amsgrad=False, foreach=True)
                                 print('model_avg -> weighted average -> main')
                                 best_models = []
                                 best_losses = []
@@ -1360,7 +1378,9 @@ class teacher(object):
         rgbas_pred = torch.stack([r_pred_img, g_pred_img, b_pred_img, a_pred_img, s_pred_img], dim=-1)
         rgbas_out = torch.permute(rgbas_out, (0, 3, 1, 2))
         rgbas_pred = torch.permute(rgbas_pred, (0, 3, 1, 2))
-        ssim_val = 1 - self.ssim_loss(tt.unsqueeze(2) * rgbas_out + tt_1.unsqueeze(2) * rgbas_pred, rgbas_pred).mean()
+        with torch.autocast('cuda', dtype=torch.bfloat16, enabled=self.device.type == 'cuda'):
+            ssim_val = 1 - self.ssim_loss(tt.unsqueeze(2) * rgbas_out + tt_1.unsqueeze(2) * rgbas_pred,
+                                          rgbas_pred).mean()
 
         A, B, C, D, E, F, G, H, I, J = 1., 1., 1., 1., 1., 1., 1., 1., 1., 1  # Note: loss weights for Custom
         # A, B, C, D, E, F, G, H, I, J = 1e1, 1e1, 3e1, 5e2, 5e2, 5e2, 1e-1, 5e-1, 5., 1.  # Note: loss weights for MSE